@@ -0,0 +1,74 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Iterator, Tuple
+
+# Entries are keyed by the version of the tables they were computed from,
+# so a write makes older results unreachable. The TTL bounds staleness from
+# writes done by other worker processes.
+CACHE_TTL_SECONDS = 30.0
+CACHE_MAX_ENTRIES = 64
+# Streamed bodies larger than this are passed through without being cached,
+# so large responses keep constant memory
+CACHE_MAX_STREAM_BYTES = 256 * 1024
+
+_versions = {"purchases": 0, "sales_targets": 0}
+_entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+_lock = threading.Lock()
+_MISS = object()
+
+
+def invalidate(table: str) -> None:
+    with _lock:
+        _versions[table] += 1
+
+
+def _lookup(key: Tuple, tables: Tuple[str, ...]) -> Tuple[Hashable, Any]:
+    with _lock:
+        full_key = (key, tuple(_versions[t] for t in tables))
+        hit = _entries.get(full_key)
+        if hit is not None and time.monotonic() - hit[0] < CACHE_TTL_SECONDS:
+            _entries.move_to_end(full_key)
+            return full_key, hit[1]
+    return full_key, _MISS
+
+
+def _store(full_key: Hashable, value: Any) -> None:
+    with _lock:
+        _entries[full_key] = (time.monotonic(), value)
+        _entries.move_to_end(full_key)
+        while len(_entries) > CACHE_MAX_ENTRIES:
+            _entries.popitem(last=False)
+
+
+def cached(key: Tuple, tables: Tuple[str, ...], compute: Callable[[], Any]) -> Any:
+    full_key, value = _lookup(key, tables)
+    if value is _MISS:
+        value = compute()
+        _store(full_key, value)
+    return value
+
+
+def cached_stream(
+    key: Tuple, tables: Tuple[str, ...], produce: Callable[[], Iterator[bytes]]
+) -> Iterator[bytes]:
+    # A hit replays the stored body as one chunk; a miss passes chunks through
+    # and stores the body once the stream completes, unless it grew too large
+    full_key, body = _lookup(key, tables)
+    if body is not _MISS:
+        return iter((body,))
+    return _record_stream(full_key, produce())
+
+
+def _record_stream(full_key: Hashable, chunks: Iterator[bytes]) -> Iterator[bytes]:
+    parts, size = [], 0
+    for chunk in chunks:
+        if parts is not None:
+            size += len(chunk)
+            if size > CACHE_MAX_STREAM_BYTES:
+                parts = None
+            else:
+                parts.append(chunk)
+        yield chunk
+    if parts is not None:
+        _store(full_key, b"".join(parts))
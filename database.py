@@ -1,11 +1,32 @@
+from sqlalchemy import event
 from sqlmodel import SQLModel, create_engine, Session
 
 DATABASE_URL = "sqlite:///./alumtrack.db"
-engine = create_engine(DATABASE_URL, echo=False)
+engine = create_engine(
+    DATABASE_URL,
+    echo=False,
+    # sessions are used from FastAPI's threadpool and asyncio.to_thread workers
+    connect_args={"check_same_thread": False},
+)
+
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_conn, _):
+    # WAL lets readers run during a write; NORMAL syncs at checkpoints only
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA mmap_size=268435456")
+    cur.close()
 
 def create_db_and_tables():
     SQLModel.metadata.create_all(engine)
+    # create_all skips indexes on tables that already exist
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
 
 def get_session():
-    with Session(engine) as session:
+    # Keep attributes loaded after commit so handlers can return them as-is
+    with Session(engine, expire_on_commit=False) as session:
         yield session
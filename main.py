@@ -1,20 +1,74 @@
-from typing import List, Dict, Any
+import asyncio
+import logging
+import os
+from typing import List, Dict, Any, BinaryIO, Callable, Iterable, Iterator
 
+import orjson
 import pandas as pd
-from fastapi import FastAPI, Depends, UploadFile, File, HTTPException, Query, Path
+from fastapi import FastAPI, Depends, UploadFile, File, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from sqlalchemy import Result, delete, func, insert
 from sqlmodel import Session, select
 
-from database import create_db_and_tables, get_session
+from cache import cached, cached_stream, invalidate
+from database import create_db_and_tables, engine, get_session
 from models import Purchase, PurchaseCreate, SalesTarget, SalesTargetCreate
-from optimizer import calculate_optimal_mix
+from optimizer import iter_optimal_mix, query_optimal_mix
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI(title="AlumTrack Backend")
 
-# Allow Lovable and your phone to connect
+# Rows inserted and committed per batch when importing purchase files
+IMPORT_BATCH_ROWS = 1000
+
+# optimal_mix entries serialised per chunk of the /optimize stream
+OPTIMIZE_STREAM_BATCH = 500
+
+# Column types expected in uploaded purchase files
+PURCHASE_FILE_DTYPES = {
+    "alloy_type": "string",
+    "purity": "float64",
+    "quantity_kg": "float64",
+    "price_per_kg": "float64",
+    "supplier": "string",
+    "notes": "string",
+}
+PURCHASE_FILE_COLUMNS = {*PURCHASE_FILE_DTYPES, "purchase_date"}
+PURCHASE_REQUIRED_COLUMNS = ["alloy_type", "purity", "quantity_kg", "price_per_kg", "purchase_date"]
+
+# Columns written by the purchase import, in table order
+PURCHASE_IMPORT_COLUMNS = [
+    "alloy_type",
+    "purity",
+    "quantity_kg",
+    "price_per_kg",
+    "purchase_date",
+    "supplier",
+    "notes",
+    "remaining_quantity_kg",
+]
+
+# Browser origins allowed to call the API. The defaults are a best guess at
+# the Lovable frontend plus local dev servers; set ALLOWED_ORIGINS to a
+# comma-separated list for the real frontend and for a phone on the LAN.
+DEFAULT_ALLOWED_ORIGINS = ",".join([
+    "https://alumtrack.lovable.app",
+    "https://alumtrack.app",
+    "http://localhost:8080",
+    "http://localhost:5173",
+])
+ALLOWED_ORIGINS = [
+    origin.strip()
+    for origin in os.environ.get("ALLOWED_ORIGINS", DEFAULT_ALLOWED_ORIGINS).split(",")
+    if origin.strip()
+]
+
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],   
+    allow_origins=ALLOWED_ORIGINS,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
@@ -22,6 +76,11 @@ app.add_middleware(
 
 @app.on_event("startup")
 def startup_event():
+    if "ALLOWED_ORIGINS" not in os.environ:
+        logger.warning(
+            "ALLOWED_ORIGINS is not set; CORS only allows the defaults: %s",
+            ", ".join(ALLOWED_ORIGINS),
+        )
     create_db_and_tables()
 
 # =========================
@@ -31,10 +90,13 @@ def startup_event():
 # Create a purchase
 @app.post("/purchases", response_model=Purchase)
 def add_purchase(data: PurchaseCreate, session: Session = Depends(get_session)):
-    purchase = Purchase(**data.dict(), remaining_quantity_kg=data.quantity_kg)
-    session.add(purchase)
+    purchase = session.execute(
+        insert(Purchase)
+        .values(**data.model_dump(), remaining_quantity_kg=data.quantity_kg)
+        .returning(Purchase)
+    ).scalar_one()
     session.commit()
-    session.refresh(purchase)
+    invalidate("purchases")
     return purchase
 
 
@@ -44,54 +106,124 @@ def list_purchases(session: Session = Depends(get_session)):
     return session.exec(select(Purchase)).all()
 
 
+def _purchase_records(df: pd.DataFrame) -> List[Dict[str, Any]]:
+    missing = [c for c in PURCHASE_REQUIRED_COLUMNS if c not in df.columns]
+    if missing:
+        raise HTTPException(400, f"Missing column(s): {', '.join(missing)}")
+    empty = [c for c in PURCHASE_REQUIRED_COLUMNS if df[c].isna().any()]
+    if empty:
+        raise HTTPException(400, f"Empty value(s) in column(s): {', '.join(empty)}")
+
+    # Uploads may mix date formats within the column, as row-wise parsing allowed
+    try:
+        purchase_date = pd.to_datetime(df["purchase_date"], format="mixed").dt.date
+    except ValueError as exc:
+        raise HTTPException(400, f"Invalid date in column 'purchase_date': {exc}")
+
+    df = df.assign(
+        purchase_date=purchase_date,
+        supplier=df.get("supplier"),
+        notes=df.get("notes"),
+        remaining_quantity_kg=df["quantity_kg"],
+    )
+    # One object array per column, NaN/NA already mapped to None
+    columns = [
+        df[name].to_numpy(dtype=object, na_value=None)
+        for name in PURCHASE_IMPORT_COLUMNS
+    ]
+    return [dict(zip(PURCHASE_IMPORT_COLUMNS, row)) for row in zip(*columns)]
+
+
+def _read_purchase_csv(source: BinaryIO) -> Iterable[pd.DataFrame]:
+    return pd.read_csv(
+        source,
+        usecols=lambda c: c in PURCHASE_FILE_COLUMNS,
+        dtype=PURCHASE_FILE_DTYPES,
+        engine="c",
+        chunksize=IMPORT_BATCH_ROWS,
+    )
+
+
+def _read_purchase_excel(source: BinaryIO) -> Iterable[pd.DataFrame]:
+    df = pd.read_excel(
+        source,
+        usecols=lambda c: c in PURCHASE_FILE_COLUMNS,
+        dtype=PURCHASE_FILE_DTYPES,
+    )
+    return (
+        df.iloc[start:start + IMPORT_BATCH_ROWS]
+        for start in range(0, len(df), IMPORT_BATCH_ROWS)
+    )
+
+
+def _import_purchases(
+    session: Session,
+    read: Callable[[BinaryIO], Iterable[pd.DataFrame]],
+    source: BinaryIO,
+) -> int:
+    # Batches are converted and inserted one at a time, so only one batch of
+    # records is held in memory; the single commit at the end means a bad
+    # row or a database error leaves nothing saved
+    rows_imported = 0
+    try:
+        for batch in read(source):
+            if batch.empty:
+                continue
+            records = _purchase_records(batch)
+            session.execute(insert(Purchase.__table__), records)
+            rows_imported += len(records)
+    except ValueError as exc:
+        session.rollback()
+        # unparseable numbers or a malformed file
+        raise HTTPException(400, f"Invalid purchase file: {exc}")
+    except Exception:
+        session.rollback()
+        raise
+
+    session.commit()
+    return rows_imported
+
+
 # Upload CSV/Excel for purchases
 @app.post("/purchases/upload")
 async def upload_purchase_file(file: UploadFile = File(...), session: Session = Depends(get_session)):
     fname = file.filename.lower()
 
     if fname.endswith(".csv"):
-        df = pd.read_csv(file.file)
+        read = _read_purchase_csv
     elif fname.endswith(".xlsx") or fname.endswith(".xls"):
-        df = pd.read_excel(file.file)
+        read = _read_purchase_excel
     else:
         raise HTTPException(400, "File must be CSV or Excel")
 
-    for _, row in df.iterrows():
-        p = Purchase(
-            alloy_type=row["alloy_type"],
-            purity=row["purity"],
-            quantity_kg=row["quantity_kg"],
-            price_per_kg=row["price_per_kg"],
-            purchase_date=pd.to_datetime(row["purchase_date"]).date(),
-            supplier=row.get("supplier"),
-            notes=row.get("notes"),
-            remaining_quantity_kg=row["quantity_kg"],
-        )
-        session.add(p)
-
-    session.commit()
-    return {"status": "ok", "rows_imported": len(df)}
+    # Parsing and inserting are blocking; keep them off the event loop.
+    # The CSV reader yields IMPORT_BATCH_ROWS rows at a time, so memory stays
+    # flat; a failed import is rolled back and leaves the cache valid.
+    rows_imported = await asyncio.to_thread(_import_purchases, session, read, file.file)
+    invalidate("purchases")
+    return {"status": "ok", "rows_imported": rows_imported}
 
 
 # UPDATE purchase
 @app.put("/purchases/{purchase_id}", response_model=Purchase)
 def update_purchase(
-    purchase_id: int = Path(...),
-    data: PurchaseCreate = None,
+    purchase_id: int,
+    data: PurchaseCreate,
     session: Session = Depends(get_session)
 ):
     purchase = session.get(Purchase, purchase_id)
     if not purchase:
         raise HTTPException(404, "Purchase not found")
 
-    for key, value in data.dict().items():
+    # fields left out of the body keep their stored values
+    for key, value in data.model_dump(exclude_unset=True).items():
         setattr(purchase, key, value)
 
     purchase.remaining_quantity_kg = data.quantity_kg
 
     session.add(purchase)
     session.commit()
-    session.refresh(purchase)
+    invalidate("purchases")
     return purchase
 
 
@@ -101,12 +233,12 @@ def delete_purchase(
     purchase_id: int,
     session: Session = Depends(get_session)
 ):
-    purchase = session.get(Purchase, purchase_id)
-    if not purchase:
+    result = session.execute(delete(Purchase).where(Purchase.id == purchase_id))
+    if result.rowcount == 0:
         raise HTTPException(404, "Not found")
 
-    session.delete(purchase)
     session.commit()
+    invalidate("purchases")
     return {"status": "deleted"}
 
 
@@ -117,10 +249,11 @@ def delete_purchase(
 # Create a sales target
 @app.post("/sales-targets", response_model=SalesTarget)
 def add_target(data: SalesTargetCreate, session: Session = Depends(get_session)):
-    target = SalesTarget.from_orm(data)
-    session.add(target)
+    target = session.execute(
+        insert(SalesTarget).values(**data.model_dump()).returning(SalesTarget)
+    ).scalar_one()
     session.commit()
-    session.refresh(target)
+    invalidate("sales_targets")
     return target
 
 
@@ -151,12 +284,12 @@ def update_sales_target(
     if not target:
         raise HTTPException(404, "Sales target not found")
 
-    for key, value in data.dict().items():
+    for key, value in data.model_dump().items():
         setattr(target, key, value)
 
     session.add(target)
     session.commit()
-    session.refresh(target)
+    invalidate("sales_targets")
     return target
 
 
@@ -166,12 +299,12 @@ def delete_sales_target(
     target_id: int,
     session: Session = Depends(get_session)
 ):
-    target = session.get(SalesTarget, target_id)
-    if not target:
+    result = session.execute(delete(SalesTarget).where(SalesTarget.id == target_id))
+    if result.rowcount == 0:
         raise HTTPException(404, "Not found")
 
-    session.delete(target)
     session.commit()
+    invalidate("sales_targets")
     return {"status": "deleted"}
 
 
@@ -179,36 +312,80 @@ def delete_sales_target(
 #     INVENTORY
 # =========================
 
-@app.get("/inventory/summary")
-def inventory_summary(session: Session = Depends(get_session)) -> Dict[str, Any]:
-    purchases = session.exec(
-        select(Purchase).where(Purchase.remaining_quantity_kg > 0)
+def _inventory_summary(session: Session) -> Dict[str, Any]:
+    rows = session.exec(
+        select(
+            Purchase.alloy_type,
+            func.sum(Purchase.remaining_quantity_kg).label("quantity_kg"),
+            func.sum(Purchase.remaining_quantity_kg * Purchase.price_per_kg).label("value"),
+        )
+        .where(Purchase.remaining_quantity_kg > 0)
+        .group_by(Purchase.alloy_type)
     ).all()
 
-    total_kg = sum(p.remaining_quantity_kg for p in purchases)
-    total_value = sum(p.remaining_quantity_kg * p.price_per_kg for p in purchases)
-
-    by_alloy: Dict[str, Dict[str, float]] = {}
-    for p in purchases:
-        rec = by_alloy.setdefault(
-            p.alloy_type,
-            {"alloy_type": p.alloy_type, "quantity_kg": 0.0, "value": 0.0},
-        )
-        rec["quantity_kg"] += p.remaining_quantity_kg
-        rec["value"] += p.remaining_quantity_kg * p.price_per_kg
+    by_alloy = [
+        {"alloy_type": r.alloy_type, "quantity_kg": r.quantity_kg, "value": r.value}
+        for r in rows
+    ]
+    total_kg = sum(r["quantity_kg"] for r in by_alloy)
+    total_value = sum(r["value"] for r in by_alloy)
 
     return {
         "total_inventory_kg": total_kg,
         "total_inventory_value": total_value,
-        "by_alloy": list(by_alloy.values()),
+        "by_alloy": by_alloy,
     }
 
 
+@app.get("/inventory/summary")
+def inventory_summary(session: Session = Depends(get_session)) -> Dict[str, Any]:
+    return cached(("inventory_summary",), ("purchases",), lambda: _inventory_summary(session))
+
+
 # =========================
 #     OPTIMIZATION
 # =========================
 
+def _optimize_stream(session: Session, year: int, month: int) -> Iterator[bytes]:
+    # Run the query before the response starts, so database errors still
+    # surface as a 500 rather than a truncated 200
+    rows = query_optimal_mix(session, year, month)
+    return _optimize_body(rows)
+
+
+def _optimize_body(rows: Result) -> Iterator[bytes]:
+    summary: Dict[str, Any] = {"to_buy": [], "total_cost_for_targets": 0.0}
+    yield b'{"optimal_mix":['
+    sep, batch = b"", []
+    for entry in iter_optimal_mix(rows, summary):
+        batch.append(orjson.dumps(entry))
+        if len(batch) == OPTIMIZE_STREAM_BATCH:
+            yield sep + b",".join(batch)
+            sep, batch = b",", []
+    if batch:
+        yield sep + b",".join(batch)
+    yield (
+        b'],"to_buy":' + orjson.dumps(summary["to_buy"])
+        + b',"total_cost_for_targets":' + orjson.dumps(summary["total_cost_for_targets"])
+        + b"}"
+    )
+
+
 @app.get("/optimize")
-def optimize(year: int, month: int, session: Session = Depends(get_session)):
-    result = calculate_optimal_mix(session, year, month)
-    return result
+def optimize(year: int, month: int):
+    # The body is produced after the request's session dependency is gone, so
+    # the response owns a session and closes it once it has been sent, even if
+    # the body was never iterated
+    session = Session(engine)
+    try:
+        body = cached_stream(
+            ("optimize", year, month),
+            ("purchases", "sales_targets"),
+            lambda: _optimize_stream(session, year, month),
+        )
+    except Exception:
+        session.close()
+        raise
+    return StreamingResponse(
+        body, media_type="application/json", background=BackgroundTask(session.close)
+    )
@@ -1,5 +1,6 @@
 from datetime import date
 from typing import Optional
+from sqlalchemy import Index, text
 from sqlmodel import SQLModel, Field
 
 # -------- Purchases --------
@@ -14,6 +15,17 @@ class PurchaseBase(SQLModel):
     notes: Optional[str] = None
 
 class Purchase(PurchaseBase, table=True):
+    # Stock still on hand, per alloy, cheapest first (summary + optimizer)
+    __table_args__ = (
+        Index(
+            "ix_purchase_remaining_alloy_price",
+            "alloy_type",
+            "price_per_kg",
+            sqlite_where=text("remaining_quantity_kg > 0"),
+            postgresql_where=text("remaining_quantity_kg > 0"),
+        ),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     remaining_quantity_kg: float = 0.0
 
@@ -29,6 +41,8 @@ class SalesTargetBase(SQLModel):
     year: int
 
 class SalesTarget(SalesTargetBase, table=True):
+    __table_args__ = (Index("ix_salestarget_year_month", "year", "month"),)
+
     id: Optional[int] = Field(default=None, primary_key=True)
 
 class SalesTargetCreate(SalesTargetBase):
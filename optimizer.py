@@ -1,68 +1,92 @@
-from collections import defaultdict
-from typing import Dict, Any, List
+from typing import Dict, Any, Iterator
+from sqlalchemy import Result, and_, func
 from sqlmodel import Session, select
 from models import Purchase, SalesTarget
 
-def calculate_optimal_mix(session: Session, year: int, month: int) -> Dict[str, Any]:
-    # 1. Get targets for that month
-    targets = session.exec(
-        select(SalesTarget).where(SalesTarget.year == year, SalesTarget.month == month)
-    ).all()
-
-    target_by_alloy = defaultdict(float)
-    for t in targets:
-        target_by_alloy[t.alloy_type] += t.target_quantity_kg
-
-    # 2. Get all inventory (purchases with remaining stock)
-    purchases = session.exec(
-        select(Purchase).where(Purchase.remaining_quantity_kg > 0)
-    ).all()
-
-    inventory = defaultdict(list)
-    for p in purchases:
-        inventory[p.alloy_type].append(p)
-
-    result: Dict[str, Any] = {
-        "optimal_mix": [],
-        "to_buy": [],
-        "total_cost_for_targets": 0.0,
-    }
-
-    # 3. For each alloy, use cheapest stock first
-    for alloy, need_qty in target_by_alloy.items():
-        left = need_qty
+def query_optimal_mix(session: Session, year: int, month: int) -> Result:
+    # 1. Total target per alloy for that month
+    targets = (
+        select(
+            SalesTarget.alloy_type,
+            func.sum(SalesTarget.target_quantity_kg).label("need"),
+        )
+        .where(SalesTarget.year == year, SalesTarget.month == month)
+        .group_by(SalesTarget.alloy_type)
+        .subquery()
+    )
 
-        batches: List[Purchase] = sorted(
-            inventory.get(alloy, []),
-            key=lambda x: x.price_per_kg
+    # 2. Inventory with a running total per alloy, cheapest stock first
+    stock = (
+        select(
+            Purchase.id,
+            Purchase.alloy_type,
+            Purchase.price_per_kg,
+            Purchase.remaining_quantity_kg,
+            func.coalesce(
+                func.sum(Purchase.remaining_quantity_kg).over(
+                    partition_by=Purchase.alloy_type,
+                    order_by=(Purchase.price_per_kg, Purchase.id),
+                    rows=(None, -1),
+                ),
+                0.0,
+            ).label("used_before"),
         )
+        .where(Purchase.remaining_quantity_kg > 0)
+        .subquery()
+    )
 
-        for b in batches:
-            if left <= 0:
-                break
+    # 3. Keep only the batches needed before each target is covered
+    return session.exec(
+        select(
+            targets.c.alloy_type,
+            targets.c.need,
+            stock.c.id,
+            stock.c.price_per_kg,
+            stock.c.remaining_quantity_kg,
+            stock.c.used_before,
+        )
+        .select_from(
+            targets.outerjoin(
+                stock,
+                and_(
+                    stock.c.alloy_type == targets.c.alloy_type,
+                    stock.c.used_before < targets.c.need,
+                ),
+            )
+        )
+        .order_by(targets.c.alloy_type, stock.c.price_per_kg, stock.c.id)
+        .execution_options(yield_per=1000)
+    )
 
-            use = min(b.remaining_quantity_kg, left)
-            if use <= 0:
-                continue
 
-            cost = use * b.price_per_kg
-            result["total_cost_for_targets"] += cost
+def iter_optimal_mix(rows: Result, summary: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    # Yields "optimal_mix" entries from query_optimal_mix rows; "to_buy" and
+    # "total_cost_for_targets" are filled into summary once exhausted
+    left_by_alloy: Dict[str, float] = {}
+    for r in rows:
+        left_by_alloy.setdefault(r.alloy_type, r.need)
+        if r.id is None:
+            # no stock at all for this alloy
+            continue
 
-            result["optimal_mix"].append({
-                "alloy_type": alloy,
-                "purchase_id": b.id,
-                "quantity_used_kg": use,
-                "price_per_kg": b.price_per_kg,
-                "cost": cost,
-            })
+        use = min(r.remaining_quantity_kg, r.need - r.used_before)
+        cost = use * r.price_per_kg
+        summary["total_cost_for_targets"] += cost
+        left_by_alloy[r.alloy_type] = r.need - r.used_before - use
 
-            left -= use
+        yield {
+            "alloy_type": r.alloy_type,
+            "purchase_id": r.id,
+            "quantity_used_kg": use,
+            "price_per_kg": r.price_per_kg,
+            "cost": cost,
+        }
 
+    for alloy, left in left_by_alloy.items():
         if left > 0:
             # not enough stock -> need to buy
-            result["to_buy"].append({
+            summary["to_buy"].append({
                 "alloy_type": alloy,
                 "missing_quantity_kg": left,
             })
 
-    return result